@@ -1,15 +1,70 @@
+from mysql.connector import FieldType
+import pandas as pd
 from DbConnector import DbConnector
 from tabulate import tabulate
 
+# pandas dtypes for the MySQL column types, other types are kept as objects.
+# DECIMAL/NEWDECIMAL are coerced to float64, so e.g. SUM() and AVG() results,
+# which MySQL returns as DECIMAL, silently lose precision beyond ~15 digits.
+DTYPES = {
+    FieldType.TINY: "Int64",
+    FieldType.SHORT: "Int64",
+    FieldType.INT24: "Int64",
+    FieldType.LONG: "Int64",
+    FieldType.LONGLONG: "Int64",
+    FieldType.YEAR: "Int64",
+    FieldType.FLOAT: "float64",
+    FieldType.DOUBLE: "float64",
+    FieldType.DECIMAL: "float64",
+    FieldType.NEWDECIMAL: "float64",
+    FieldType.DATE: "datetime64[ns]",
+    FieldType.DATETIME: "datetime64[ns]",
+    FieldType.TIMESTAMP: "datetime64[ns]",
+    FieldType.VAR_STRING: "string",
+    FieldType.STRING: "string",
+}
+
 
 class DbHandler:
     """The Database handler. Containing all functionality to interact with the database"""
 
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, **connection):
+        """Connect to the database
+
+        Args:
+            connection: Overrides the settings from the environment, e.g.: HOST="127.0.0.1", PORT=3307
+        """
+        self.connection = DbConnector(**connection)
         self.db_connection = self.connection.db_connection
         self.cursor = self.connection.cursor
 
+    def close_connection(self):
+        """Close the connection to the database"""
+        self.connection.close_connection()
+
+    def for_user(self, user_id: str) -> "DbHandler":
+        """Get the database that stores a user, its activities and trackpoints
+
+        Args:
+            user_id (str): id of the user
+
+        Returns:
+            DbHandler: the database
+        """
+        return self
+
+    def map_shards(self, func) -> list:
+        """Run a function on every shard of the database.
+        Used to compute partial results that are merged by the caller.
+
+        Args:
+            func (Callable): called with the DbHandler of the shard
+
+        Returns:
+            list: the result for every shard
+        """
+        return [func(self)]
+
     def create_table(self, tables: list):
         """Create tables and insert into DB
         Tables = [
@@ -66,13 +121,14 @@ class DbHandler:
         self.db_connection.commit()
         return self.cursor.lastrowid
 
-    def insert_trackpoints(self, values, partition=100):
+    def insert_trackpoints(self, values, partition=100, table="TrackPoint"):
         """Insert multiple trackpoints trackpoint
 
         Args:
             values (list[list | tuple]): A list of trackpoints
+            table (str, optional): The trackpoint table. Defaults to "TrackPoint".
         """
-        query = "INSERT INTO TrackPoint (activity_id, lat, lon, altitude, date_days, date_time) values "
+        query = f"INSERT INTO {table} (activity_id, lat, lon, altitude, date_days, date_time) values "
         print(f"  inserting {len(values)} trackpoints")
 
         # Insert
@@ -91,6 +147,53 @@ class DbHandler:
                 prepared_values += ","
         self.db_connection.commit()
 
+    def bump_dataset_version(self):
+        """Increment the ingest generation counter of the dataset"""
+        query = (
+            "INSERT INTO DatasetVersion (id, generation) VALUES (1, 1) "
+            "ON DUPLICATE KEY UPDATE generation = generation + 1"
+        )
+        self.cursor.execute(query)
+        self.db_connection.commit()
+
+    def get_dataset_version(self) -> "str | None":
+        """Get a version stamp of the dataset.
+        Combines the ingest generation with the highest ids,
+        so it changes whenever data is inserted.
+
+        Returns:
+            str | None: the version stamp, e.g.: "3-16048-9681756",
+                or None if the dataset was inserted without a DatasetVersion table
+        """
+        if not self.table_exists("DatasetVersion"):
+            return None
+
+        query = """
+            SELECT
+                (SELECT MAX(generation) FROM DatasetVersion),
+                (SELECT MAX(id) FROM Activity),
+                (SELECT MAX(id) FROM TrackPoint);
+        """
+        self.cursor.execute(query)
+        return "-".join(map(str, self.cursor.fetchone()))
+
+    def table_exists(self, table_name: str) -> bool:
+        """Check if a table exists in the database
+
+        Args:
+            table_name (str): name of table
+
+        Returns:
+            bool: True if the table exists
+        """
+        query = """
+            SELECT count(*)
+            FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = %s;
+        """
+        self.cursor.execute(query, (table_name,))
+        return self.cursor.fetchone()[0] > 0
+
     def drop_table(self, table_name: str):
         """Drop a table from the database
 
@@ -112,6 +215,77 @@ class DbHandler:
         self.cursor.execute(query)
         return self.cursor.fetchall()
 
+    def explain_partitions(self, query) -> list:
+        """Get the partitions each table in a query will read
+
+        Args:
+            query (str): a SELECT query
+
+        Returns:
+            list[tuple]: (table, partitions) for every table in the query plan
+        """
+        self.cursor.execute("EXPLAIN " + query)
+        rows = self.cursor.fetchall()
+        table = self.cursor.column_names.index("table")
+        partitions = self.cursor.column_names.index("partitions")
+        return [(row[table], row[partitions]) for row in rows]
+
+    def query_dataframe(self, query, batch_size=100000) -> pd.DataFrame:
+        """Execute a query and get the result as a DataFrame.
+        The rows are fetched in batches and collected per column,
+        and every column gets the dtype of its MySQL type.
+
+        Args:
+            query (str): the query
+            batch_size (int, optional): Number of rows to fetch at a time. Defaults to 100000.
+
+        Returns:
+            pd.DataFrame: the result
+        """
+        self.cursor.execute(query)
+        description = self.cursor.description
+        columns = [[] for _ in description]
+        while True:
+            rows = self.cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for column, values in zip(columns, zip(*rows)):
+                column.extend(values)
+
+        return pd.DataFrame(
+            {
+                name: pd.Series(values, dtype=DTYPES.get(type_code, "object"))
+                for (name, type_code, *_), values in zip(description, columns)
+            }
+        )
+
+    def query_arrow(self, query, batch_size=100000) -> "pyarrow.Table":
+        """Execute a query and get the result as an Arrow table.
+        pyarrow is only needed for this method, so it is imported here.
+
+        Args:
+            query (str): the query
+            batch_size (int, optional): Number of rows to fetch at a time. Defaults to 100000.
+
+        Returns:
+            pyarrow.Table: the result
+        """
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(
+            self.query_dataframe(query, batch_size), preserve_index=False
+        )
+
+    def export_parquet(self, query, path):
+        """Execute a query and write the result to a Parquet file.
+        pandas picks the Parquet engine, pyarrow or fastparquet.
+
+        Args:
+            query (str): the query
+            path (str): path to the file
+        """
+        self.query_dataframe(query).to_parquet(path, index=False)
+
     def get_nr_rows(self, table) -> int:
         """Get number of rows from table"""
         query = "SELECT count(*) as count FROM %s"
@@ -0,0 +1,146 @@
+class _Node:
+    """A node in the centered interval tree.
+    Holds the labels that contain the center, sorted by start and by end,
+    and the subtrees with the labels entirely before and after the center.
+    """
+
+    def __init__(self, labels):
+        endpoints = sorted(time for label in labels for time in label[:2])
+        self.center = endpoints[len(endpoints) // 2]
+
+        before, after, here = [], [], []
+        for label in labels:
+            if label[1] < self.center:
+                before.append(label)
+            elif label[0] > self.center:
+                after.append(label)
+            else:
+                here.append(label)
+
+        self.by_start = sorted(here, key=lambda label: label[0])
+        self.by_end = sorted(here, key=lambda label: label[1], reverse=True)
+        self.left = _Node(before) if before else None
+        self.right = _Node(after) if after else None
+
+
+def _collect_overlapping(node, start, end, found):
+    """Collect the labels in a subtree that overlap the time window [start, end]"""
+    while node is not None:
+        if end < node.center:
+            # Every label here ends after the window starts
+            for label in node.by_start:
+                if label[0] > end:
+                    break
+                found.append(label)
+            node = node.left
+        elif start > node.center:
+            # Every label here starts before the window ends
+            for label in node.by_end:
+                if label[1] < start:
+                    break
+                found.append(label)
+            node = node.right
+        else:
+            # The window contains the center, so it overlaps every label here
+            found.extend(node.by_start)
+            _collect_overlapping(node.left, start, end, found)
+            node = node.right
+
+
+class LabelIndex:
+    """A centered interval tree over the labels of a single user.
+
+    Every node holds the labels that contain its center, so a lookup only visits
+    the paths down to the start and end of the time window, and the labels that
+    overlap it: O(log n + k) per lookup, where k is the number of overlapping labels.
+
+    Example:
+    index = LabelIndex([(start, end, "bus"), (start, end, "walk"), ...])
+    index.match(activity_start, activity_end)  // "bus" | None
+    """
+
+    def __init__(self, labels):
+        """Build the index
+
+        Args:
+            labels (Iterable[tuple]): (start_date_time, end_date_time, transportation_mode)
+        """
+        self.labels = list(labels)
+        self.root = _Node(self.labels) if self.labels else None
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def overlapping(self, start, end) -> list:
+        """Find all labels that overlap the time window [start, end]
+
+        Args:
+            start (datetime): start of the window
+            end (datetime): end of the window
+
+        Returns:
+            list[tuple]: the overlapping labels, sorted by start time
+        """
+        found = []
+        _collect_overlapping(self.root, start, end, found)
+        return sorted(found, key=lambda label: label[0])
+
+    def match(self, start, end, min_coverage=0.5) -> "str | None":
+        """Match a time window to the transportation mode of the label
+        that overlaps it the most.
+
+        Args:
+            start (datetime): start of the window
+            end (datetime): end of the window
+            min_coverage (float, optional): The fraction of the window that the label must cover. Defaults to 0.5.
+
+        Returns:
+            str | None: the transportation mode, or None if no label covers enough of the window
+        """
+        best_mode = None
+        best_overlap = None
+        for label_start, label_end, mode in self.overlapping(start, end):
+            overlap = min(end, label_end) - max(start, label_start)
+            if best_overlap is None or overlap > best_overlap:
+                best_mode, best_overlap = mode, overlap
+
+        if best_overlap is None:
+            return None
+        duration = (end - start).total_seconds()
+        if duration > 0 and best_overlap.total_seconds() / duration < min_coverage:
+            return None
+        return best_mode
+
+    def find(self, time) -> "tuple | None":
+        """Find the label that contains a point in time
+
+        Args:
+            time (datetime): the point in time
+
+        Returns:
+            tuple | None: the label that started most recently, or None
+        """
+        labels = self.overlapping(time, time)
+        return labels[-1] if labels else None
+
+    def split(self, data_points, key) -> "list[list]":
+        """Split a trajectory at the label boundaries.
+        Consecutive points that fall inside the same label (or outside any label)
+        end up in the same segment.
+
+        Args:
+            data_points (list): the trajectory, sorted by time
+            key (Callable): returns the datetime of a data point
+
+        Returns:
+            list[list]: the segments of the trajectory
+        """
+        segments = []
+        current_label = object()
+        for data_point in data_points:
+            label = self.find(key(data_point))
+            if label is not current_label:
+                segments.append([])
+                current_label = label
+            segments[-1].append(data_point)
+        return segments
@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+
+
+class ResultCache:
+    """A cache for task results, stored as JSON on disk.
+    Every entry is stamped with the dataset version it was computed from,
+    and a fingerprint of the code that computed it.
+    Entries from other versions are stale and evicted on load,
+    entries with another fingerprint are misses.
+
+    Example:
+    cache = ResultCache(db.get_dataset_version())
+    result = cache.get("task_1", fingerprint)  // None on a miss
+    cache.set("task_1", result, fingerprint)
+    cache.save()
+    """
+
+    def __init__(self, version: str, path=os.path.join(".cache", "part2.json")):
+        self.version = version
+        self.path = path
+        self.entries = {}
+
+        # Load entries, evict the stale ones
+        # A missing or corrupt file is an empty cache
+        try:
+            with open(path, "r", encoding="utf-8") as cache_file:
+                entries = json.load(cache_file)
+        except (OSError, ValueError):
+            entries = {}
+        if isinstance(entries, dict):
+            self.entries = {
+                key: entry
+                for key, entry in entries.items()
+                if isinstance(entry, dict) and entry.get("version") == version
+            }
+
+    def get(self, key: str, fingerprint=None):
+        """Get a cached result
+
+        Args:
+            key (str): the key, e.g. the task name
+            fingerprint (str | None, optional): Fingerprint of the code that computes the result. Defaults to None.
+
+        Returns:
+            any | None: the result, or None if it is not cached
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry.get("fingerprint") != fingerprint:
+            return None
+        return entry["result"]
+
+    def set(self, key: str, result, fingerprint=None):
+        """Cache a result for the current dataset version
+
+        Args:
+            key (str): the key, e.g. the task name
+            result (any): a JSON serializable result
+            fingerprint (str | None, optional): Fingerprint of the code that computed the result. Defaults to None.
+        """
+        self.entries[key] = {
+            "version": self.version,
+            "fingerprint": fingerprint,
+            "result": result,
+        }
+
+    def save(self):
+        """Write the cache to disk.
+        Writes to a temporary file that replaces the cache,
+        so concurrent readers never see a partly written file.
+        """
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
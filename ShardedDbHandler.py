@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+import zlib
+import pandas as pd
+from decouple import config, Csv
+from DbHandler import DbHandler
+
+
+class ShardedDbHandler:
+    """A database sharded over multiple MySQL instances.
+    Every user, with its activities and trackpoints, is stored on the shard
+    given by a hash of the user id, so joins on user stay within a shard.
+    Queries run on every shard in parallel, and the results are merged client-side.
+
+    The shards are read from SHARDS in the environment,
+    while the other settings are shared with DbConnector.
+
+    Example:
+    SHARDS = "127.0.0.1:3306,127.0.0.1:3307" // host:port of every shard
+    """
+
+    def __init__(self, shards=config("SHARDS", default="", cast=Csv())):
+        self.shards = []
+        for shard in shards:
+            host, _, port = shard.partition(":")
+            self.shards.append(DbHandler(HOST=host, PORT=port or 3306))
+
+    def close_connection(self):
+        """Close the connection to every shard"""
+        for shard in self.shards:
+            shard.close_connection()
+
+    def for_user(self, user_id: str) -> DbHandler:
+        """Get the shard that stores a user, its activities and trackpoints.
+        Uses crc32, as the builtin hash of a str changes between runs.
+
+        Args:
+            user_id (str): id of the user
+
+        Returns:
+            DbHandler: the shard
+        """
+        return self.shards[zlib.crc32(str(user_id).encode()) % len(self.shards)]
+
+    def map_shards(self, func) -> list:
+        """Run a function on every shard in parallel
+
+        Args:
+            func (Callable): called with the DbHandler of the shard
+
+        Returns:
+            list: the result for every shard
+        """
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            return list(executor.map(func, self.shards))
+
+    def create_table(self, tables: list):
+        """Create the tables on every shard"""
+        self.map_shards(lambda shard: shard.create_table(tables))
+
+    def drop_table(self, table_name: str):
+        """Drop a table from every shard"""
+        for shard in self.shards:
+            shard.drop_table(table_name)
+
+    def show_tables(self):
+        """Print tables in every shard"""
+        for i, shard in enumerate(self.shards):
+            print(f"\nShard {i}")
+            shard.show_tables()
+
+    def insert_user(self, values):
+        """Insert a user into its shard"""
+        self.for_user(values[0]).insert_user(values)
+
+    def insert_activity(self, values) -> "int | None":
+        """Insert an activity into the shard of its user"""
+        return self.for_user(values[0]).insert_activity(values)
+
+    def bump_dataset_version(self):
+        """Increment the ingest generation counter of every shard"""
+        self.map_shards(lambda shard: shard.bump_dataset_version())
+
+    def get_dataset_version(self) -> "str | None":
+        """Get a version stamp of the dataset, combined from every shard.
+        None if any of the shards has no version.
+        """
+        versions = self.map_shards(lambda shard: shard.get_dataset_version())
+        return None if None in versions else "|".join(versions)
+
+    def table_exists(self, table_name: str) -> bool:
+        """Check if a table exists on every shard"""
+        return all(self.map_shards(lambda shard: shard.table_exists(table_name)))
+
+    def execute_query(self, query) -> list:
+        """Execute a query on every shard and concatenate the rows.
+        Only complete for queries where every group is within one user,
+        aggregations across users have to be merged by the caller (see map_shards).
+        """
+        return [
+            row
+            for rows in self.map_shards(lambda shard: shard.execute_query(query))
+            for row in rows
+        ]
+
+    def query_dataframe(self, query, batch_size=100000) -> pd.DataFrame:
+        """Execute a query on every shard and concatenate the DataFrames.
+        Activity ids are only unique within a shard, so a shard column is added:
+        group by ["shard", "activity_id"], or use map_shards for per shard results.
+
+        Args:
+            query (str): the query
+            batch_size (int, optional): Number of rows to fetch at a time. Defaults to 100000.
+
+        Returns:
+            pd.DataFrame: the result, with the index of the shard in the first column
+        """
+        dfs = self.map_shards(lambda shard: shard.query_dataframe(query, batch_size))
+        for i, df in enumerate(dfs):
+            df.insert(0, "shard", i)
+        return pd.concat(dfs, ignore_index=True)
+
+    def query_arrow(self, query, batch_size=100000) -> "pyarrow.Table":
+        """Execute a query on every shard and get the result as an Arrow table,
+        with the shard column from query_dataframe.
+        pyarrow is only needed for this method, so it is imported here.
+
+        Args:
+            query (str): the query
+            batch_size (int, optional): Number of rows to fetch at a time. Defaults to 100000.
+
+        Returns:
+            pyarrow.Table: the result
+        """
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(
+            self.query_dataframe(query, batch_size), preserve_index=False
+        )
+
+    def export_parquet(self, query, path):
+        """Execute a query on every shard and write the result to a Parquet file,
+        with the shard column from query_dataframe.
+
+        Args:
+            query (str): the query
+            path (str): path to the file
+        """
+        self.query_dataframe(query).to_parquet(path, index=False)
+
+    def explain_partitions(self, query) -> list:
+        """Get the partitions each table in a query will read, on every shard"""
+        return [
+            row
+            for rows in self.map_shards(lambda shard: shard.explain_partitions(query))
+            for row in rows
+        ]
+
+    def get_nr_rows(self, table) -> int:
+        """Get number of rows from table on every shard"""
+        return sum(self.map_shards(lambda shard: shard.get_nr_rows(table)))
+
+
+def get_db_handler() -> "DbHandler | ShardedDbHandler":
+    """Connect to the database, sharded if SHARDS is set in the environment
+
+    Returns:
+        DbHandler | ShardedDbHandler: the database
+    """
+    shards = config("SHARDS", default="", cast=Csv())
+    return ShardedDbHandler(shards) if shards else DbHandler()
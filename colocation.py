@@ -0,0 +1,256 @@
+import argparse
+import itertools
+import math
+import os
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+from haversine import haversine, Unit
+from tabulate import tabulate
+from DbHandler import DbHandler
+from geo import EARTH_RADIUS
+from ShardedDbHandler import get_db_handler
+
+
+def get_trackpoints(db: DbHandler) -> list:
+    """Get every trackpoint with the user that recorded it
+
+    Args:
+        db (DbHandler): the database
+
+    Returns:
+        list[tuple]: (user_id, lat, lon, unix time)
+    """
+    query = """
+        SELECT
+            Activity.user_id, TrackPoint.lat, TrackPoint.lon,
+            UNIX_TIMESTAMP(TrackPoint.date_time)
+        FROM TrackPoint
+        INNER JOIN Activity ON TrackPoint.activity_id=Activity.id;
+    """
+    return [
+        (uid, float(lat), float(lon), int(t))
+        for uid, lat, lon, t in db.execute_query(query)
+    ]
+
+
+def build_grid(trackpoints, distance, seconds) -> dict:
+    """Bucket the trackpoints into space x time cells.
+    The points are placed on a sphere in meters, and bucketed on x, y, z and time.
+    The straight line between two points is never longer than the distance on the surface,
+    so points within the distance and seconds of each other are in neighboring cells.
+
+    Args:
+        trackpoints (list[tuple]): (user_id, lat, lon, unix time)
+        distance (float): size of the cells in meters
+        seconds (int): size of the cells in seconds
+
+    Returns:
+        dict: {(t, x, y, z): [(user_id, lat, lon, unix time), ...], ...}
+    """
+    grid = defaultdict(list)
+    for trackpoint in trackpoints:
+        _, lat, lon, t = trackpoint
+        lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+        x = EARTH_RADIUS * math.cos(lat_rad) * math.cos(lon_rad)
+        y = EARTH_RADIUS * math.cos(lat_rad) * math.sin(lon_rad)
+        z = EARTH_RADIUS * math.sin(lat_rad)
+        cell = (
+            t // seconds,
+            math.floor(x / distance),
+            math.floor(y / distance),
+            math.floor(z / distance),
+        )
+        grid[cell].append(trackpoint)
+    return grid
+
+
+def get_forward_offsets() -> list:
+    """Get the offsets to the neighboring cells that come after a cell.
+    Every pair of neighboring cells is then only compared once.
+
+    Returns:
+        list[tuple]: 40 of the 80 offsets to the neighbors in 4 dimensions
+    """
+    return [
+        offset
+        for offset in itertools.product((-1, 0, 1), repeat=4)
+        if offset > (0, 0, 0, 0)
+    ]
+
+
+def find_encounters(cells, grid, distance, seconds) -> dict:
+    """Find the co-located users in the given cells
+
+    Args:
+        cells (list[tuple]): the cells to compare with themselves and their forward neighbors
+        grid (dict): the cells and their neighbors
+        distance (float): max distance in meters
+        seconds (int): max time difference in seconds
+
+    Returns:
+        dict: {(user_a, user_b): {time window, ...}, ...}
+    """
+    offsets = get_forward_offsets()
+    encounters = defaultdict(set)
+
+    def compare(points_a, points_b):
+        for uid_a, lat_a, lon_a, t_a in points_a:
+            for uid_b, lat_b, lon_b, t_b in points_b:
+                if uid_a == uid_b or abs(t_a - t_b) > seconds:
+                    continue
+                meters = haversine((lat_a, lon_a), (lat_b, lon_b), unit=Unit.METERS)
+                if meters <= distance:
+                    pair = (uid_a, uid_b) if uid_a < uid_b else (uid_b, uid_a)
+                    encounters[pair].add(min(t_a, t_b) // seconds)
+
+    for cell in cells:
+        points = grid[cell]
+
+        # Pairs within the cell
+        for i, point in enumerate(points):
+            compare([point], points[i + 1 :])
+
+        # Pairs with the neighboring cells
+        for offset in offsets:
+            neighbor = grid.get(tuple(c + o for c, o in zip(cell, offset)))
+            if neighbor is not None:
+                compare(points, neighbor)
+    return encounters
+
+
+def _find_encounters_in_partition(args) -> dict:
+    return find_encounters(*args)
+
+
+def partition_grid(grid, n_partitions) -> list:
+    """Split the grid into partitions of whole time slices, balanced on the work.
+    The work of a time slice is the sum of its squared cell sizes,
+    as the number of candidate pairs grows with the square of the points in a cell.
+    Each partition gets its own cells and the next time slice,
+    which holds the forward neighbors of its last time slice.
+
+    Args:
+        grid (dict): the cells
+        n_partitions (int): number of partitions
+
+    Returns:
+        list[tuple]: (cells, grid) for every partition
+    """
+    slices = defaultdict(list)
+    for cell in grid:
+        slices[cell[0]].append(cell)
+    times = sorted(slices)
+    work = [sum(len(grid[cell]) ** 2 for cell in slices[t]) for t in times]
+
+    # Cut where the cumulative work passes the next multiple of the target
+    target = sum(work) / n_partitions
+    groups = [[]]
+    cumulative = 0
+    for t, slice_work in zip(times, work):
+        if cumulative >= target * len(groups) and groups[-1]:
+            groups.append([])
+        groups[-1].append(t)
+        cumulative += slice_work
+
+    partitions = []
+    for group in filter(None, groups):
+        cells = [cell for t in group for cell in slices[t]]
+        halo = slices.get(group[-1] + 1, [])
+        partitions.append((cells, {cell: grid[cell] for cell in cells + halo}))
+    return partitions
+
+
+def find_colocated_users(
+    trackpoints, distance=100, seconds=60, processes=None
+) -> dict:
+    """Find the users that were within a distance of each other within a time.
+    An encounter is counted once per pair of users for each time window of the given seconds.
+
+    Args:
+        trackpoints (list[tuple]): (user_id, lat, lon, unix time)
+        distance (float, optional): max distance in meters. Defaults to 100.
+        seconds (int, optional): max time difference in seconds. Defaults to 60.
+        processes (int | None, optional): number of processes. Defaults to the number of CPUs.
+
+    Returns:
+        dict: {(user_a, user_b): encounters, ...}
+    """
+    processes = processes or os.cpu_count()
+    grid = build_grid(trackpoints, distance, seconds)
+    partitions = partition_grid(grid, processes)
+
+    with Pool(processes) as pool:
+        results = pool.map(
+            _find_encounters_in_partition,
+            [(cells, cell_grid, distance, seconds) for cells, cell_grid in partitions],
+        )
+
+    # Merge the partitions
+    encounters = defaultdict(set)
+    for result in results:
+        for pair, windows in result.items():
+            encounters[pair] |= windows
+    return {pair: len(windows) for pair, windows in encounters.items()}
+
+
+def benchmark(db: DbHandler, distance, seconds, max_processes):
+    """Time the co-location search on the full dataset with 1..max_processes processes"""
+    start = time.perf_counter()
+    trackpoints = get_trackpoints(db)
+    elapsed = time.perf_counter() - start
+    print(f"Fetched {len(trackpoints)} trackpoints in {round(elapsed, 3)} s")
+
+    timings = []
+    for processes in range(1, max_processes + 1):
+        start = time.perf_counter()
+        encounters = find_colocated_users(trackpoints, distance, seconds, processes)
+        elapsed = time.perf_counter() - start
+        timings.append((processes, len(encounters), round(elapsed, 3)))
+
+    print(tabulate(timings, headers=["Processes", "Pairs", "Time (s)"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find co-located users")
+    parser.add_argument("--distance", type=float, default=100, help="meters")
+    parser.add_argument("--seconds", type=int, default=60, help="seconds")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="time the search with 1..processes processes",
+    )
+    args = parser.parse_args()
+
+    db = None
+    try:
+        db = get_db_handler()
+
+        if args.benchmark:
+            benchmark(db, args.distance, args.seconds, args.processes or 4)
+            return
+
+        encounters = find_colocated_users(
+            get_trackpoints(db), args.distance, args.seconds, args.processes
+        )
+        encounters = sorted(encounters.items(), key=lambda x: x[1], reverse=True)
+
+        # Print
+        print(
+            f"Users within {args.distance} m and {args.seconds} s of each other: \n"
+            + tabulate(
+                [(a, b, count) for (a, b), count in encounters],
+                headers=["User", "User", "Encounters"],
+            )
+        )
+
+    except Exception as e:
+        print("ERROR: Failed to use database:", e)
+    finally:
+        if db:
+            db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# Mean earth radius in meters, the same as the haversine package uses
+EARTH_RADIUS = 6371008.8
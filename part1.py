@@ -1,12 +1,22 @@
+import argparse
 from datetime import datetime
 import os
 from DbHandler import DbHandler
 from FileHandler import read_data_file, read_labeled_users_file, read_user_labels_file
+from LabelIndex import LabelIndex
+from ShardedDbHandler import ShardedDbHandler, get_db_handler
+from trajectory import douglas_peucker
 
 
-def create_tables() -> list:
+def create_tables(partition_by=None, keep_raw=False) -> list:
     """Create the tables for the database
 
+    Args:
+        partition_by (str | None, optional): Range partition Activity and TrackPoint by "year" or "month".
+            MySQL does not support foreign keys on partitioned tables,
+            so the partitioned layout uses plain indexes instead. Defaults to None.
+        keep_raw (bool, optional): Create the TrackPointRaw table for the unsimplified trackpoints. Defaults to False.
+
     Returns:
         list: a list of all the tables to insert
     """
@@ -23,27 +33,75 @@ def create_tables() -> list:
         """
     )
 
-    # Activity
+    if partition_by is None:
+        # Activity
+        tables.append(
+            """
+                CREATE TABLE IF NOT EXISTS `Activity` (
+                    `id` INT NOT NULL AUTO_INCREMENT,
+                    `user_id` varchar(3) NOT NULL,
+                    `transportation_mode` varchar(40),
+                    `start_date_time` DATETIME,
+                    `end_date_time` DATETIME,
+                    PRIMARY KEY (`id`),
+                    FOREIGN KEY (`user_id`)
+                        REFERENCES User(id)
+                        ON DELETE CASCADE
+                )
+            """
+        )
+    else:
+        # Activity, partitioned on the start time
+        # The partition key has to be part of the primary key
+        tables.append(
+            f"""
+                CREATE TABLE IF NOT EXISTS `Activity` (
+                    `id` INT NOT NULL AUTO_INCREMENT,
+                    `user_id` varchar(3) NOT NULL,
+                    `transportation_mode` varchar(40),
+                    `start_date_time` DATETIME NOT NULL,
+                    `end_date_time` DATETIME,
+                    PRIMARY KEY (`id`, `start_date_time`),
+                    KEY (`user_id`)
+                )
+                {get_partition_clause("start_date_time", partition_by)}
+            """
+        )
+
+    # TrackPoint
+    tables.append(get_trackpoint_table("TrackPoint", partition_by))
+
+    # TrackPointRaw, the full resolution trajectories when TrackPoint is simplified
+    if keep_raw:
+        tables.append(get_trackpoint_table("TrackPointRaw", partition_by))
+
+    # DatasetVersion
+    # Bumped by every ingest, used to invalidate cached results
     tables.append(
         """
-            CREATE TABLE IF NOT EXISTS `Activity` (
-                `id` INT NOT NULL AUTO_INCREMENT,
-                `user_id` varchar(3) NOT NULL,
-                `transportation_mode` varchar(40),
-                `start_date_time` DATETIME,
-                `end_date_time` DATETIME,
-                PRIMARY KEY (`id`),
-                FOREIGN KEY (`user_id`)
-                    REFERENCES User(id)
-                    ON DELETE CASCADE
+            CREATE TABLE IF NOT EXISTS `DatasetVersion` (
+                `id` INT NOT NULL,
+                `generation` INT NOT NULL,
+                PRIMARY KEY (`id`)
             )
         """
     )
+    return tables
 
-    # TrackPoint
-    tables.append(
-        """
-            CREATE TABLE IF NOT EXISTS `TrackPoint` (
+
+def get_trackpoint_table(table_name: str, partition_by=None) -> str:
+    """Create a trackpoint table
+
+    Args:
+        table_name (str): name of the table
+        partition_by (str | None, optional): Range partition by "year" or "month". Defaults to None.
+
+    Returns:
+        str: the table
+    """
+    if partition_by is None:
+        return f"""
+            CREATE TABLE IF NOT EXISTS `{table_name}` (
                 `id` INT NOT NULL AUTO_INCREMENT,
                 `activity_id` INT,
                 `lat` DOUBLE,
@@ -57,71 +115,182 @@ def create_tables() -> list:
                     ON DELETE CASCADE
             )
         """
-    )
-    return tables
 
+    # Partitioned on the time of the trackpoint
+    return f"""
+        CREATE TABLE IF NOT EXISTS `{table_name}` (
+            `id` INT NOT NULL AUTO_INCREMENT,
+            `activity_id` INT,
+            `lat` DOUBLE,
+            `lon` DOUBLE,
+            `altitude` INT,
+            `date_days` DOUBLE,
+            `date_time` DATETIME NOT NULL,
+            PRIMARY KEY (`id`, `date_time`),
+            KEY (`activity_id`)
+        )
+        {get_partition_clause("date_time", partition_by)}
+    """
+
+
+def get_partition_clause(
+    column: str, partition_by: str, first_year=2000, last_year=2012
+) -> str:
+    """Create the range partitions for a DATETIME column.
+    Rows outside of the years end up in the first or the last partition.
 
-def parse_and_insert_dataset(db: DbHandler, stop_at_user=""):
+    Args:
+        column (str): name of the column
+        partition_by (str): "year" or "month"
+        first_year (int, optional): The first year with data. Defaults to 2000.
+        last_year (int, optional): The last year with data. Defaults to 2012.
+
+    Returns:
+        str: the PARTITION BY clause
+    """
+    partitions = []
+    if partition_by == "year":
+        for year in range(first_year, last_year + 1):
+            partitions.append(f"PARTITION p{year} VALUES LESS THAN ({year + 1})")
+        expression = f"YEAR(`{column}`)"
+    elif partition_by == "month":
+        for year in range(first_year, last_year + 1):
+            for month in range(1, 13):
+                next_month = f"{year + month // 12}-{month % 12 + 1:02d}-01"
+                partitions.append(
+                    f"PARTITION p{year}{month:02d} "
+                    f"VALUES LESS THAN (TO_DAYS('{next_month}'))"
+                )
+        expression = f"TO_DAYS(`{column}`)"
+    else:
+        raise ValueError(f"Unknown partitioning: {partition_by}")
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+
+    return f"PARTITION BY RANGE ({expression}) ({', '.join(partitions)})"
+
+
+def parse_and_insert_dataset(
+    db: "DbHandler | ShardedDbHandler",
+    stop_at_user="",
+    split_on_labels=False,
+    tolerance=None,
+):
     """Will parse the dataset and insert the users,
     the activities and all the trackpoints for each activity.
 
     Args:
-        program (DbHandler): the database
+        db (DbHandler | ShardedDbHandler): the database
+        stop_at_user (str, optional): Stop the insert when reaching this user. Defaults to "".
+        split_on_labels (bool, optional): Split the trajectories at the label boundaries. Defaults to False.
+        tolerance (float | None, optional): Simplify the trajectories with this tolerance in meters,
+            and keep the full resolution trackpoints in TrackPointRaw. Defaults to None.
     """
     path_to_dataset = os.path.join("./dataset")
+    path_to_data = os.path.join(path_to_dataset, "Data")
 
     labeled_ids = read_labeled_users_file(
         os.path.join(path_to_dataset, "labeled_ids.txt")
     )
-    user = ""
-    labels = {}
-    has_labels = False
-    for root, dirs, files in os.walk(os.path.join(path_to_dataset, "Data")):
-        # New user?
-        # Directory has a "Trajectory" folder,
-        # meaning we are in a new users directory
-        if len(dirs) > 0 and dirs[0] == "Trajectory":
-            user = os.path.normpath(root).split(os.path.sep)[-1]
-
-            # Partial insert, 0..stop_at_user-1
-            if user == stop_at_user:
-                return
-
-            # Get labels
-            if user in labeled_ids and files[0] == "labels.txt":
-                labels = read_user_labels_file(os.path.join(root, files[0]))
-                has_labels = True
-            else:
-                has_labels = False
-
-            # insert user into db
-            _ = db.insert_user([user, has_labels])
-
-        # Insert activities with Trajectory data
-        # In "Trajectory" directory
-        if os.path.normpath(root).split(os.path.sep)[-1] == "Trajectory":
-            values = []
-            for file in files:
-                insert_trajectory(user, root, file, has_labels, labels, db, values)
-            db.insert_trackpoints(values)
+
+    # Partial insert, 0..stop_at_user-1
+    users = sorted(os.listdir(path_to_data))
+    if stop_at_user in users:
+        users = users[: users.index(stop_at_user)]
+
+    # Every shard inserts its own users, and the shards insert in parallel.
+    # The user, its activities and trackpoints are stored on the same shard
+    def insert_users(shard: DbHandler):
+        for user in users:
+            if db.for_user(user) is shard:
+                insert_user_directory(
+                    user,
+                    os.path.join(path_to_data, user),
+                    user in labeled_ids,
+                    shard,
+                    split_on_labels,
+                    tolerance,
+                )
+
+    db.map_shards(insert_users)
+
+
+def insert_user_directory(
+    user, root, is_labeled, db: DbHandler, split_on_labels=False, tolerance=None
+):
+    """Insert a user, with an activity and trackpoints for every trajectory
+
+    Args:
+        user (str): id of the user
+        root (str): path to the directory of the user
+        is_labeled (bool): the user is in labeled_ids.txt
+        db (DbHandler): the database, or the shard of the user
+        split_on_labels (bool, optional): Split the trajectories at the label boundaries. Defaults to False.
+        tolerance (float | None, optional): Simplify the trajectories with this tolerance in meters. Defaults to None.
+    """
+    # Get labels
+    labels = LabelIndex([])
+    labels_path = os.path.join(root, "labels.txt")
+    has_labels = is_labeled and os.path.exists(labels_path)
+    if has_labels:
+        labels = build_label_index(read_user_labels_file(labels_path))
+
+    # insert user into db
+    _ = db.insert_user([user, has_labels])
+
+    # Insert activities with Trajectory data
+    # In "Trajectory" directory
+    trajectory_root = os.path.join(root, "Trajectory")
+    values = []
+    raw_values = [] if tolerance is not None else None
+    for file in sorted(os.listdir(trajectory_root)):
+        insert_trajectory(
+            user,
+            trajectory_root,
+            file,
+            has_labels,
+            labels,
+            db,
+            values,
+            split_on_labels,
+            tolerance,
+            raw_values,
+        )
+    db.insert_trackpoints(values)
+    if raw_values is not None:
+        db.insert_trackpoints(raw_values, table="TrackPointRaw")
+
+
+def build_label_index(labels: dict) -> LabelIndex:
+    """Build the interval index for the labels of a user
+
+    Args:
+        labels (dict): labels as returned by read_user_labels_file
+
+    Returns:
+        LabelIndex: the labels sorted by start time
+    """
+    return LabelIndex(
+        (
+            get_datetime_format(label[0], label[1]),
+            get_datetime_format(label[2], label[3]),
+            label[4],
+        )
+        for label in labels.values()
+    )
 
 
 def insert_activity(
-    user, file, data_points, has_labels, labels, db: DbHandler
+    user, data_points, has_labels, labels: LabelIndex, db: DbHandler
 ) -> "int | None":
     # Prepare activity
     start_date_time = get_datetime_format(data_points[0][5], data_points[0][6])
     end_date_time = get_datetime_format(data_points[-1][5], data_points[-1][6])
 
     # Match Transportation mode
+    # The label that overlaps the activity the most
     transportation_mode = None
     if has_labels:
-        # Get activity from dict
-        activity = labels.get(os.path.splitext(file)[0])
-        if activity is not None:
-            # Match end time
-            if get_datetime_format(activity[2], activity[3]) == end_date_time:
-                transportation_mode = activity[4]
+        transportation_mode = labels.match(start_date_time, end_date_time)
 
     # Insert
     return db.insert_activity(
@@ -130,7 +299,16 @@ def insert_activity(
 
 
 def insert_trajectory(
-    user, root, file, has_labels, labels: dict, db: DbHandler, values
+    user,
+    root,
+    file,
+    has_labels,
+    labels: LabelIndex,
+    db: DbHandler,
+    values,
+    split_on_labels=False,
+    tolerance=None,
+    raw_values=None,
 ):
     path = os.path.join(root, file)
     data = read_data_file(path)[6:]
@@ -139,13 +317,39 @@ def insert_trajectory(
     if len(data) > 2500:
         return
 
-    # Insert Activity
-    activity_id = insert_activity(user, file, data, has_labels, labels, db)
-    if activity_id is None:
-        raise ValueError(f"Activity {path} was not inserted!")
+    # Split the trajectory into one activity per label
+    segments = [data]
+    if has_labels and split_on_labels:
+        segments = labels.split(
+            data, key=lambda dp: get_datetime_format(dp[5], dp[6])
+        )
 
-    # Prepare data for insertion
-    for trackpoint in data:
+    for segment in segments:
+        # Insert Activity
+        activity_id = insert_activity(user, segment, has_labels, labels, db)
+        if activity_id is None:
+            raise ValueError(f"Activity {path} was not inserted!")
+
+        # Simplify the trajectory, keep the full resolution on the side
+        if tolerance is not None:
+            raw_values.extend(prepare_trackpoints(activity_id, segment))
+            segment = douglas_peucker(segment, tolerance)
+
+        values.extend(prepare_trackpoints(activity_id, segment))
+
+
+def prepare_trackpoints(activity_id, data_points) -> "list[list]":
+    """Prepare the data points of an activity for insertion
+
+    Args:
+        activity_id (int): id of the activity
+        data_points (list[list]): the data points from the trajectory file
+
+    Returns:
+        list[list]: the trackpoints
+    """
+    trackpoints = []
+    for trackpoint in data_points:
         lat = trackpoint[0]
         lon = trackpoint[1]
         altitude = int(round(float(trackpoint[3])))
@@ -153,7 +357,8 @@ def insert_trajectory(
         date_time = get_datetime_format(trackpoint[5], trackpoint[6])
 
         # Append dp to activity
-        values.append([activity_id, lat, lon, altitude, date_days, date_time])
+        trackpoints.append([activity_id, lat, lon, altitude, date_days, date_time])
+    return trackpoints
 
 
 def get_datetime_format(date, time) -> datetime:
@@ -172,18 +377,42 @@ def get_datetime_format(date, time) -> datetime:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Insert the Geolife dataset")
+    parser.add_argument(
+        "--split-on-labels",
+        action="store_true",
+        help="split the trajectories at the label boundaries",
+    )
+    parser.add_argument(
+        "--partition-by",
+        choices=["year", "month"],
+        help="range partition Activity and TrackPoint by time",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="simplify the trajectories with this tolerance in meters, "
+        "task 9 and 10 in part 2 then read the full resolution TrackPointRaw",
+    )
+    args = parser.parse_args()
+
     db = None
-    tables = create_tables()
+    tables = create_tables(args.partition_by, keep_raw=args.tolerance is not None)
     try:
-        db = DbHandler()
+        db = get_db_handler()
 
         # Drop tables
+        # db.drop_table("DatasetVersion")
+        # db.drop_table("TrackPointRaw")
         # db.drop_table("TrackPoint")
         # db.drop_table("Activity")
         # db.drop_table("User")
 
         db.create_table(tables)
-        parse_and_insert_dataset(db)
+        parse_and_insert_dataset(
+            db, split_on_labels=args.split_on_labels, tolerance=args.tolerance
+        )
+        db.bump_dataset_version()
 
         db.show_tables()
 
@@ -191,7 +420,7 @@ def main():
         print("ERROR: Failed to use database:", e)
     finally:
         if db:
-            db.connection.close_connection()
+            db.close_connection()
 
 
 if __name__ == "__main__":
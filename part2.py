@@ -1,8 +1,21 @@
+import argparse
+import contextlib
+import hashlib
+import heapq
+import io
 import itertools
+import time
+import types
 import pandas as pd
 from haversine import haversine, Unit
 from tabulate import tabulate
 from DbHandler import DbHandler
+from ShardedDbHandler import get_db_handler
+from ResultCache import ResultCache
+
+# Bump when the output of the tasks changes because of code outside of this module,
+# e.g. in DbHandler. Changes in this module are picked up by get_fingerprint.
+CACHE_SCHEMA = 1
 
 
 def task_1(db: DbHandler):
@@ -38,7 +51,9 @@ def task_3(db: DbHandler):
         ORDER BY nr_activities DESC 
         LIMIT 20;
     """
-    ret = db.execute_query(query)
+    # Top 20 per shard, merged into the overall top 20
+    partials = db.map_shards(lambda shard: shard.execute_query(query))
+    ret = heapq.nlargest(20, itertools.chain(*partials), key=lambda row: row[1])
 
     # Print
     print("\nTask 3")
@@ -71,7 +86,9 @@ def task_5(db: DbHandler):
         WHERE transportation_mode IS NOT NULL 
         GROUP BY transportation_mode;
     """
-    ret = db.execute_query(query)
+    # Sum the counts from every shard
+    partials = db.map_shards(lambda shard: dict(shard.execute_query(query)))
+    ret = list(merge_sums(partials).items())
 
     # Print
     print("\nTask 5")
@@ -90,12 +107,12 @@ def task_6(db: DbHandler):
         SELECT 
             YEAR(start_date_time) as year, count(*) as nr_activities 
         FROM Activity 
-        GROUP BY year 
-        ORDER BY nr_activities DESC 
-        LIMIT 1;
+        GROUP BY year;
     """
-    ret = db.execute_query(query)[0]
-    most_activities_year = ret[0]
+    # Sum the counts from every shard
+    partials = db.map_shards(lambda shard: dict(shard.execute_query(query)))
+    activities = merge_sums(partials)
+    most_activities_year = max(activities, key=activities.get)
 
     # Get year with most recorded hours
     query = (
@@ -126,21 +143,46 @@ def task_6(db: DbHandler):
 
 def task_7(db: DbHandler):
     """Find the total distance (in km) walked in 2008, by user with id=112."""
-    query = """
-        SELECT activity_id, lat, lon 
-        FROM TrackPoint 
-        WHERE activity_id IN ( 
-            SELECT id 
-            FROM Activity 
-        WHERE user_id = '112' AND transportation_mode = 'walk' 
-        );
+    distance = get_walked_distance(db, "112", 2008)
+
+    # Print
+    print("\nTask 7")
+    print(f"User 112 walked {round(distance, 3)} km in 2008")
+
+
+def get_walked_distance(
+    db: DbHandler, user_id: str, year: int, table="TrackPoint"
+) -> float:
+    """Find the total distance (in km) a user walked in a year
+
+    Args:
+        db (DbHandler): the database
+        user_id (str): id of the user
+        year (int): the year
+        table (str, optional): The trackpoint table. Defaults to "TrackPoint".
+
+    Returns:
+        float: the distance in km
     """
-    ret = db.execute_query(query)
+    query = get_walked_query(user_id, year, table)
+
+    # Partial distances from every shard
+    return sum(db.map_shards(lambda shard: get_distance(shard.execute_query(query))))
+
+
+def get_distance(ret) -> float:
+    """Sum the distance (in km) between consecutive trackpoints of the same activity
 
+    Args:
+        ret (list[tuple]): (activity_id, lat, lon) ordered by activity
+
+    Returns:
+        float: the distance in km
+    """
     # Calulates the distance between the points
     # Assumes that the points are in order for each activity
     distance = 0.0
-    aid = ret[0][0]
+    aid = ret[0][0] if ret else None
     for x in range(1, len(ret)):
         # Same activity?
         if aid == ret[x][0]:
@@ -150,39 +192,54 @@ def task_7(db: DbHandler):
         else:
             # New activity, Update aid
             aid = ret[x][0]
+    return distance
 
-    # Print
-    print("\nTask 7")
-    print(f"User 112 walked {round(distance, 3)} km in 2008")
 
+def get_walked_query(
+    user_id: str, year: int, table="TrackPoint", prune=True
+) -> str:
+    """Create the query for the trackpoints a user walked in a year.
+    Both tables are filtered on a time range, so MySQL only reads the
+    partitions of that year when the tables are partitioned.
+    The rows are ordered by activity and time, as an activity that crosses
+    a partition boundary is otherwise read in pieces.
 
-def task_8(db: DbHandler):
-    """Find the top 20 users who have gained the most altitude meters"""
-    query = """
-        SELECT 
-            Activity.user_id, TrackPoint.activity_id, TrackPoint.altitude 
-        FROM TrackPoint 
-        INNER JOIN Activity ON TrackPoint.activity_id=Activity.id;
+    Args:
+        user_id (str): id of the user
+        year (int): the year
+        table (str, optional): The trackpoint table. Defaults to "TrackPoint".
+        prune (bool, optional): Let MySQL prune the partitions. With False, the time columns
+            are wrapped in an expression, which gives the same rows but reads every partition.
+            Defaults to True.
+
+    Returns:
+        str: the query
     """
-    ret = db.execute_query(query)
+    date_time, start, end = "date_time", "start_date_time", "end_date_time"
+    if not prune:
+        date_time, start, end = (
+            f"DATE_ADD({column}, INTERVAL 0 SECOND)"
+            for column in (date_time, start, end)
+        )
 
-    altitude = {}
-    current_aid = -1
-    old_alt = -1
-    for uid, aid, alt in ret:
-        # Same activity
-        if aid == current_aid:
-            # Not invalid + new alt is higher
-            if old_alt < alt and alt != -777 and old_alt != -777:
-                diff = alt - old_alt
-                # add altitude
-                altitude[uid] = (
-                    altitude[uid] + diff if altitude.get(uid) is not None else diff
-                )
-        else:
-            # New activity
-            current_aid = aid
-        old_alt = alt
+    return f"""
+        SELECT activity_id, lat, lon 
+        FROM {table} 
+        WHERE {date_time} >= '{year}-01-01' AND {date_time} < '{year + 1}-01-01' 
+        AND activity_id IN ( 
+            SELECT id 
+            FROM Activity 
+            WHERE user_id = '{user_id}' AND transportation_mode = 'walk' 
+            AND {start} < '{year + 1}-01-01' 
+            AND {end} >= '{year}-01-01' 
+        ) 
+        ORDER BY activity_id, date_time;
+    """
+
+
+def task_8(db: DbHandler):
+    """Find the top 20 users who have gained the most altitude meters"""
+    altitude = get_altitude_gained(db)
 
     # Sort dict
     # source: https://stackoverflow.com/a/2258273
@@ -196,32 +253,67 @@ def task_8(db: DbHandler):
     )
 
 
+def get_altitude_gained(db: DbHandler, table="TrackPoint") -> dict:
+    """Find the altitude meters gained by every user
+
+    Args:
+        db (DbHandler): the database
+        table (str, optional): The trackpoint table. Defaults to "TrackPoint".
+
+    Returns:
+        dict: {user_id: gained altitude, ...}
+    """
+    query = f"""
+        SELECT 
+            Activity.user_id, {table}.activity_id, {table}.altitude 
+        FROM {table} 
+        INNER JOIN Activity ON {table}.activity_id=Activity.id;
+    """
+    # Partial sums from every shard
+    partials = db.map_shards(
+        lambda shard: get_altitude_gained_per_user(shard.query_dataframe(query))
+    )
+    return merge_sums(partials)
+
+
+def get_altitude_gained_per_user(df: pd.DataFrame) -> dict:
+    """Sum the altitude gained between consecutive trackpoints of the same activity
+
+    Args:
+        df (pd.DataFrame): user_id, activity_id and altitude of the trackpoints
+
+    Returns:
+        dict: {user_id: gained altitude, ...}
+    """
+    # Altitude change between consecutive trackpoints of the same activity
+    # Ignore invalid altitudes (-777), and only count the gains
+    previous = df.groupby("activity_id")["altitude"].shift()
+    diff = df["altitude"] - previous
+    gained = (diff > 0) & (df["altitude"] != -777) & (previous != -777)
+    gained = gained.fillna(False).astype(bool)
+
+    altitude = diff[gained].groupby(df["user_id"][gained]).sum()
+    return {uid: int(alt) for uid, alt in altitude.items()}
+
+
 def task_9(db: DbHandler):
     """Find all users who have invalid activities, and the number of invalid activities per user
     An invalid activity is defined as an activity with consecutive
     trackpoints where the timestamps deviate with at least 5 minutes.
     """
-    query = """
+    # Simplified trajectories have gaps between the kept trackpoints
+    table = get_full_resolution_table(db)
+    query = f"""
         SELECT 
-            Activity.user_id, TrackPoint.activity_id, TrackPoint.date_time 
-        FROM TrackPoint 
-        INNER JOIN Activity ON TrackPoint.activity_id=Activity.id;
+            Activity.user_id, {table}.activity_id, {table}.date_time 
+        FROM {table} 
+        INNER JOIN Activity ON {table}.activity_id=Activity.id;
     """
-    ret = db.execute_query(query)
-
-    users = {}
-    curr_aid = -1
-    old_dt = None
-    for uid, aid, dt in ret:
-        # If same activity
-        if aid == curr_aid:
-            # Calulate the time between the trackpoints in minutes
-            diff = divmod((dt - old_dt).total_seconds(), 60)[0]
-            if diff >= 5:
-                users[uid] = users[uid] + 1 if users.get(uid) is not None else 1
-        else:
-            curr_aid = aid
-        old_dt = dt
+    # Partial counts from every shard
+    partials = db.map_shards(
+        lambda shard: get_invalid_per_user(shard.query_dataframe(query))
+    )
+    users = merge_sums(partials)
 
     # Print
     print("\nTask 9")
@@ -230,16 +322,33 @@ def task_9(db: DbHandler):
     )
 
 
+def get_invalid_per_user(df: pd.DataFrame) -> dict:
+    """Count the consecutive trackpoints of the same activity that are at least 5 minutes apart
+
+    Args:
+        df (pd.DataFrame): user_id, activity_id and date_time of the trackpoints
+
+    Returns:
+        dict: {user_id: count, ...}
+    """
+    # Time between consecutive trackpoints of the same activity
+    gap = df.groupby("activity_id")["date_time"].diff()
+    invalid = df[gap >= pd.Timedelta(minutes=5)]
+    return invalid.groupby("user_id").size().to_dict()
+
+
 def task_10(db: DbHandler):
     """Find the users who have tracked an activity in the Forbidden City of Beijing.
     the Forbidden City: lat 39.916, lon 116.397
     """
-    query = """
+    # Simplified trajectories can skip the trackpoints in the Forbidden City
+    table = get_full_resolution_table(db)
+    query = f"""
         SELECT Activity.user_id
         FROM (
             SELECT 
                 activity_id, ROUND(lat, 3) AS lat, ROUND(lon, 3) AS lon
-            FROM TrackPoint
+            FROM {table}
             HAVING lat = '39.916' AND lon = '116.397'
         ) as activities
         INNER JOIN Activity ON activities.activity_id=Activity.id
@@ -282,6 +391,36 @@ def task_11(db: DbHandler):
     )
 
 
+def get_full_resolution_table(db: DbHandler) -> str:
+    """Get the table with every trackpoint.
+    When part1 simplified the trajectories (--tolerance), TrackPoint only holds
+    the simplified ones, and the full resolution trackpoints are in TrackPointRaw.
+
+    Args:
+        db (DbHandler): the database
+
+    Returns:
+        str: "TrackPointRaw" if it exists, else "TrackPoint"
+    """
+    return "TrackPointRaw" if db.table_exists("TrackPointRaw") else "TrackPoint"
+
+
+def merge_sums(partials) -> dict:
+    """Merge partial results from the shards by summing the values per key
+
+    Args:
+        partials (list[dict]): a key:value pair store for every shard
+
+    Returns:
+        dict: the summed values
+    """
+    merged = {}
+    for partial in partials:
+        for key, value in partial.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
 def tabulate_dict(data, headers) -> str:
     """Will tabulate a dict that has the format of key:value
 
@@ -296,29 +435,174 @@ def tabulate_dict(data, headers) -> str:
     return tabulate(df, headers=headers, floatfmt=".0f")
 
 
+def explain_time_scoped_queries(db: DbHandler):
+    """Print the partitions read by the time scoped queries and how long they take,
+    next to the same queries where the partitions can not be pruned
+    """
+    queries = {
+        "Task 7": (
+            get_walked_query("112", 2008),
+            get_walked_query("112", 2008, prune=False),
+        ),
+        "Activities in 2008": tuple(
+            f"""
+                SELECT user_id, count(*) 
+                FROM Activity 
+                WHERE {column} >= '2008-01-01' AND {column} < '2009-01-01' 
+                GROUP BY user_id;
+            """
+            for column in [
+                "start_date_time",
+                "DATE_ADD(start_date_time, INTERVAL 0 SECOND)",
+            ]
+        ),
+    }
+
+    for name, (pruned, unpruned) in queries.items():
+        print(f"\n{name}")
+        for label, query in [("Pruned", pruned), ("Not pruned", unpruned)]:
+            start = time.perf_counter()
+            db.execute_query(query)
+            elapsed = time.perf_counter() - start
+
+            print(f"{label} ({round(elapsed, 3)} s)")
+            print(
+                tabulate(db.explain_partitions(query), headers=["Table", "Partitions"])
+            )
+
+
+def run_task(task, db: DbHandler) -> str:
+    """Run a task and capture what it prints
+
+    Args:
+        task (Callable): the task
+        db (DbHandler): the database
+
+    Returns:
+        str: the output of the task
+    """
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            task(db)
+    except Exception:
+        # Show what the task printed before it failed
+        print(output.getvalue(), end="")
+        raise
+    return output.getvalue()
+
+
+def get_fingerprint(task) -> str:
+    """Fingerprint the code of a task, used to invalidate its cached output.
+    Hashes the bytecode, constants, names and defaults of the task, and of every
+    function in this module that it calls, directly or through other functions.
+    Module level constants that the code reads are hashed by value.
+
+    Args:
+        task (Callable): the task
+
+    Returns:
+        str: the fingerprint
+    """
+    digest = hashlib.sha256(str(CACHE_SCHEMA).encode())
+    seen = set()
+
+    def add_value(value):
+        digest.update(type(value).__name__.encode())
+        digest.update(repr(value).encode())
+
+    def add_code(code):
+        digest.update(code.co_code)
+        # The bytecode refers to names and variables by index, so hash the names too
+        names = (code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars)
+        digest.update(repr(names).encode())
+        for const in code.co_consts:
+            # Nested functions and lambdas have code objects as constants
+            if isinstance(const, types.CodeType):
+                add_code(const)
+            else:
+                add_value(const)
+        for name in code.co_names:
+            if name in seen or name not in globals():
+                continue
+            seen.add(name)
+            value = globals()[name]
+            if isinstance(value, types.FunctionType):
+                if value.__module__ == __name__:
+                    add_function(value)
+            elif isinstance(value, (bool, int, float, str, bytes, tuple, frozenset)):
+                add_value(value)
+
+    def add_function(func):
+        add_value(func.__defaults__)
+        add_value(func.__kwdefaults__)
+        add_code(func.__code__)
+
+    add_function(task)
+    return digest.hexdigest()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Run the part 2 tasks")
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="ignore the cached results and run every task",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="show the partitions read by the time scoped queries",
+    )
+    args = parser.parse_args()
+
+    tasks = [
+        task_1,
+        task_2,
+        task_3,
+        task_4,
+        task_5,
+        task_6,
+        task_7,
+        task_8,
+        task_9,
+        task_10,
+        task_11,
+    ]
+
     db = None
+    cache = None
     try:
-        db = DbHandler()
+        db = get_db_handler()
+        if args.explain:
+            explain_time_scoped_queries(db)
+            return
+
+        # No cache for datasets inserted without a DatasetVersion table
+        version = db.get_dataset_version()
+        cache = ResultCache(version) if version is not None else None
 
         # Execute the tasks:
-        task_1(db)
-        task_2(db)
-        task_3(db)
-        task_4(db)
-        task_5(db)
-        task_6(db)
-        task_7(db)
-        task_8(db)
-        task_9(db)
-        task_10(db)
-        task_11(db)
+        # Reuse the output from the cache if the dataset has not changed
+        for task in tasks:
+            fingerprint = get_fingerprint(task)
+            output = None
+            if cache is not None and not args.refresh:
+                output = cache.get(task.__name__, fingerprint)
+            if output is None:
+                output = run_task(task, db)
+                if cache is not None:
+                    cache.set(task.__name__, output, fingerprint)
+            print(output, end="")
 
     except Exception as e:
         print("ERROR: Failed to use database:", e)
     finally:
+        # Keep the output of the tasks that finished
+        if cache is not None:
+            cache.save()
         if db:
-            db.connection.close_connection()
+            db.close_connection()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+import argparse
+import time
+from decouple import config, Csv
+from tabulate import tabulate
+from part1 import create_tables, parse_and_insert_dataset
+from part2 import run_task, task_3, task_5, task_8, task_9
+from ShardedDbHandler import ShardedDbHandler
+
+
+def benchmark(db: ShardedDbHandler, stop_at_user="") -> tuple:
+    """Insert the dataset into the shards, and time the ingest and the part 2 scans
+
+    Args:
+        db (ShardedDbHandler): the shards
+        stop_at_user (str, optional): Stop the insert when reaching this user. Defaults to "".
+
+    Returns:
+        tuple: (ingest seconds, part 2 seconds)
+    """
+    # TrackPointRaw first, as it references Activity
+    tables = ["DatasetVersion", "TrackPointRaw", "TrackPoint", "Activity", "User"]
+    for table in tables:
+        db.drop_table(table)
+    db.create_table(create_tables())
+
+    start = time.perf_counter()
+    parse_and_insert_dataset(db, stop_at_user)
+    ingest = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for task in [task_3, task_5, task_8, task_9]:
+        run_task(task, db)
+    scan = time.perf_counter() - start
+    return ingest, scan
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the scaling from 1 to N shards. "
+        "The shards are read from BENCHMARK_SHARDS, and their tables are dropped!"
+    )
+    parser.add_argument(
+        "--stop-at-user", default="", help="only insert the users before this one"
+    )
+    parser.add_argument(
+        "--yes", action="store_true", help="drop the tables without asking"
+    )
+    args = parser.parse_args()
+
+    # Separate from SHARDS, so the benchmark never drops the tables of the live shards
+    shards = config("BENCHMARK_SHARDS", default="", cast=Csv())
+    live_shards = set(config("SHARDS", default="", cast=Csv()))
+    if live_shards.intersection(shards):
+        print("ERROR: BENCHMARK_SHARDS must not include any of SHARDS")
+        return
+    if not args.yes:
+        answer = input(f"Drop all tables on {', '.join(shards)}? [y/N] ")
+        if answer.strip().lower() != "y":
+            return
+
+    timings = []
+    for n in range(1, len(shards) + 1):
+        db = None
+        try:
+            db = ShardedDbHandler(shards[:n])
+            ingest, scan = benchmark(db, args.stop_at_user)
+            timings.append((n, round(ingest, 3), round(scan, 3)))
+        except Exception as e:
+            print("ERROR: Failed to use database:", e)
+        finally:
+            if db:
+                db.close_connection()
+
+    print(tabulate(timings, headers=["Shards", "Ingest (s)", "Part 2 (s)"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+from tabulate import tabulate
+from DbHandler import DbHandler
+from ShardedDbHandler import get_db_handler
+from part2 import get_altitude_gained, get_walked_distance
+
+
+def report(db: DbHandler):
+    """Print the compression ratio of TrackPoint against TrackPointRaw,
+    and the error it gives for the results of task 7 and task 8.
+    Task 9 (time gaps) and task 10 (single trackpoints) are not reliable on
+    simplified trajectories, so part 2 runs them on TrackPointRaw.
+    """
+    raw_rows = db.get_nr_rows("TrackPointRaw")
+    rows = db.get_nr_rows("TrackPoint")
+
+    raw_distance = get_walked_distance(db, "112", 2008, "TrackPointRaw")
+    distance = get_walked_distance(db, "112", 2008, "TrackPoint")
+
+    raw_altitude = get_altitude_gained(db, "TrackPointRaw")
+    altitude = get_altitude_gained(db, "TrackPoint")
+    max_altitude_error = max(
+        (abs(raw_altitude[uid] - altitude.get(uid, 0)) for uid in raw_altitude),
+        default=0,
+    )
+
+    def error(raw, simplified):
+        return round(100 * (simplified - raw) / raw, 2) if raw else 0.0
+
+    print("\nSimplification")
+    print(f"Compression ratio: {round(raw_rows / rows, 2) if rows else 0}")
+    print(
+        tabulate(
+            [
+                ["Trackpoints", raw_rows, rows, error(raw_rows, rows)],
+                [
+                    "Task 7: walked (km)",
+                    round(raw_distance, 3),
+                    round(distance, 3),
+                    error(raw_distance, distance),
+                ],
+                [
+                    "Task 8: gained altitude (m)",
+                    sum(raw_altitude.values()),
+                    sum(altitude.values()),
+                    error(sum(raw_altitude.values()), sum(altitude.values())),
+                ],
+            ],
+            headers=["", "Full resolution", "Simplified", "Error (%)"],
+        )
+    )
+    print(f"Largest gained altitude error for a user: {max_altitude_error} m")
+    print("Task 9 and task 10 read TrackPointRaw, and are not affected")
+
+
+def main():
+    db = None
+    try:
+        db = get_db_handler()
+        report(db)
+
+    except Exception as e:
+        print("ERROR: Failed to use database:", e)
+    finally:
+        if db:
+            db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
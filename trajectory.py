@@ -0,0 +1,75 @@
+import math
+from geo import EARTH_RADIUS
+
+
+def project(data_points) -> "list[tuple]":
+    """Project the data points to a plane in meters,
+    centered on the latitude of the first point (equirectangular projection)
+
+    Args:
+        data_points (list[list]): the data points of a trajectory, [lat, lon, ...]
+
+    Returns:
+        list[tuple]: (x, y) in meters
+    """
+    lat_scale = math.cos(math.radians(float(data_points[0][0])))
+    return [
+        (
+            EARTH_RADIUS * math.radians(float(dp[1])) * lat_scale,
+            EARTH_RADIUS * math.radians(float(dp[0])),
+        )
+        for dp in data_points
+    ]
+
+
+def get_segment_distance(point, start, end) -> float:
+    """Get the distance from a point to the line segment between start and end"""
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length = dx * dx + dy * dy
+    if length == 0:
+        return math.dist(point, start)
+
+    # Closest point on the segment
+    t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length
+    t = max(0.0, min(1.0, t))
+    return math.dist(point, (start[0] + t * dx, start[1] + t * dy))
+
+
+def douglas_peucker(data_points, tolerance) -> list:
+    """Simplify a trajectory with the Douglas-Peucker algorithm.
+    Keeps the first and last point, and every point needed to keep
+    the trajectory within the tolerance of the original.
+
+    Args:
+        data_points (list[list]): the data points of a trajectory, [lat, lon, ...]
+        tolerance (float): max distance in meters between the original and the simplified trajectory
+
+    Returns:
+        list[list]: the data points that are kept
+    """
+    if len(data_points) < 3:
+        return list(data_points)
+
+    coordinates = project(data_points)
+    keep = [False] * len(data_points)
+    keep[0] = keep[-1] = True
+
+    # Iterative, to not hit the recursion limit on long trajectories
+    stack = [(0, len(data_points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_distance = 0.0
+        index = None
+        for i in range(first + 1, last):
+            distance = get_segment_distance(
+                coordinates[i], coordinates[first], coordinates[last]
+            )
+            if distance > max_distance:
+                max_distance, index = distance, i
+
+        if index is not None and max_distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [dp for dp, kept in zip(data_points, keep) if kept]